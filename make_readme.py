@@ -18,88 +18,351 @@
 # - MJD
 # - Center of frequency band (MHz)
 #
+# The README summarises this information over all of the files. The details for
+# each individual file are written alongside it in JSON Lines format (one JSON
+# object per line), in a file named after the README: for README.txt, that's
+# README_files.jsonl.
+#
 # Example usage:
 #
 # > python make_readme.py -d /path/to/data/ -n survey_README.txt -g your_name
 #
+# Headers that have been read are remembered in a cache file, .make_readme_cache.json,
+# in the output directory. Running the script again only reads the headers of files
+# that are new or have changed since the last run; delete the cache file to force
+# everything to be read again.
+#
 # Issues that could pop up:
-# - The script intentionally ignores symlinks. It won't break; it will just ignore them.
+# - The script intentionally ignores symlinked files. It won't break; it will just ignore
+#   them. Symlinked directories are searched, though, since data trees are often put
+#   together out of them. A directory that can be reached more than once is only
+#   searched once, under its real path if it's inside the data directory.
 # - It will only run on PSRFITS files and filterbank files.
-# - It will break if it runs across a FITS file that is not PSRTFITS format.
+# - It can't make sense of FITS files that are not PSRFITS format. These (and any other
+#   files whose headers can't be read) are reported and skipped.
 #
 # Things to do:
 # - Add options to filter by frequency, MJD, source name, etc. You can already
-#   filter by files by going into this code and editing the list of valid extensions,
+#   filter by files by going into this code and editing the extensions in parsers,
 #   but it would be nice to do that, and the other filters, on the command line.
 #
-# Technical note: The code reads PSRFITS files using the pdat module and filterbank
-# files using sigpyproc, a python implementation of SIGPROC. This is for flexibility
-# with different types of PSRFITS files, as well as dealing with some edge cases --
-# for example, sigpyproc's reader for PSRFITS files only works on search mode data
-# with the observing mode listed as "SEARCH". I know of a few instances where search
-# mode data has its mode listed as "SRCH", which breaks sigpyproc but not pdat.
+# Technical note: Everything needed from a PSRFITS file is in its primary header, so
+# only that header is read rather than opening the whole file. Usually the keywords
+# of interest all sit in the first 2880-byte block of the file, and the code parses
+# that block itself; if the header runs on past the first block, it's read using
+# fitsio (falling back on astropy if fitsio isn't installed or can't read a file).
+# Filterbank headers are parsed by the code itself too, following the SIGPROC header
+# format, so the file is never memory-mapped or opened as a whole. This is also for
+# flexibility with different types of PSRFITS files, as well as dealing with some
+# edge cases -- for example, sigpyproc's reader for PSRFITS files only works on
+# search mode data with the observing mode listed as "SEARCH". I know of a few
+# instances where search mode data has its mode listed as "SRCH", which breaks
+# sigpyproc but not a plain header read.
 #
 # All that said, this code will absolutely break on many other kinds of data! There
 # are more weird cases I don't know about; I've written it specifically for the surveys
 # I'm going through. Feel free to modify as needed.
 
 import argparse
-import datetime
 import getpass
-import glob
+import itertools
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
+import re
+import struct
 import sys
+import tempfile
 import time
 
-import pdat
-from sigpyproc.readers import FilReader
-
-parser = argparse.ArgumentParser(description='User inputs')
-parser.add_argument('-d', help='Directory to search [Default: current working directory]', type=str)
-parser.add_argument('-n', help='Name of output file [Default: "README.txt"]', type=str)
-parser.add_argument('-l', help='Location of output file [Default: current working directory]', type=str)
-parser.add_argument('-o', help='Owner of directory [Default: "Unknown"]', type=str)
-parser.add_argument('-g', help='Person generating README [Default: "Unknown"]', type=str)
-parser.add_argument('-v', help='Verbose option [Default: False]', type=bool)
-args = parser.parse_args()
-
-################################################################
-# Use arguments and default values to change specific settings #
-################################################################
-if args.d:
-    data_directory = args.d
-else:
-    data_directory = os.getcwd() + '/'
-if args.n:
-    output_name = args.n
-else:
-    output_name = 'README.txt'
-if args.l:
-    output_directory = args.l
-else:
-    output_directory = os.getcwd() + '/'
-if args.o:
-    owner = args.o
-else:
-    owner = 'Unknown'
-if args.g:
-    generator = args.g
-else:
-    # getpass finds your username. It should work on both Windows and Unix systems.
-    generator = getpass.getuser()
-if args.v:
-    verbose = args.v
-    if verbose not in [True, False]:
-        print('-v must be True or False!')
-        sys.exit()
-else:
-    verbose = False
+from astropy.io import fits
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+# The primary header keywords parse_data needs from a PSRFITS file.
+psrfits_keywords = frozenset(['TELESCOP', 'OBSERVER', 'PROJID', 'SRC_NAME', 'OBS_MODE', 'STT_IMJD', 'STT_SMJD', 'OBSFREQ'])
+
+# Picks the value out of the value field of a FITS header card: either a quoted
+# string (in which a literal quote is written as two quotes) or a bare value,
+# which ends at whitespace or the "/" that starts a comment.
+card_value_re = re.compile(rb"\s*(?:'((?:[^']|'')*)'?|([^\s/]*))")
+
+# struct formats of the values that follow each SIGPROC header keyword. Strings
+# (with their own length prefix) are marked with 'str', and keywords that just
+# mark the start or end of a section have no value at all.
+sigproc_keywords = {
+    'HEADER_START': None,
+    'HEADER_END': None,
+    'FREQUENCY_START': None,
+    'FREQUENCY_END': None,
+    'source_name': 'str',
+    'rawdatafile': 'str',
+    'telescope_id': '<i',
+    'machine_id': '<i',
+    'data_type': '<i',
+    'barycentric': '<i',
+    'pulsarcentric': '<i',
+    'nbits': '<i',
+    'nsamples': '<i',
+    'nchans': '<i',
+    'nifs': '<i',
+    'nbeams': '<i',
+    'ibeam': '<i',
+    'nbins': '<i',
+    'npuls': '<q',
+    'signed': '<b',
+    'tstart': '<d',
+    'tsamp': '<d',
+    'fch1': '<d',
+    'foff': '<d',
+    'fchannel': '<d',
+    'refdm': '<d',
+    'period': '<d',
+    'az_start': '<d',
+    'za_start': '<d',
+    'src_raj': '<d',
+    'src_dej': '<d',
+}
+
+# SIGPROC's telescope IDs, from its aliases.c.
+sigproc_telescopes = {
+    0: 'Fake',
+    1: 'Arecibo',
+    2: 'Ooty',
+    3: 'Nancay',
+    4: 'Parkes',
+    5: 'Jodrell',
+    6: 'GBT',
+    7: 'GMRT',
+    8: 'Effelsberg',
+    9: 'ATA',
+    10: 'SRT',
+    11: 'LOFAR',
+    12: 'VLA',
+    20: 'CHIME',
+    21: 'FAST',
+    64: 'MeerKAT',
+    65: 'KAT-7',
+}
+
+def parse_card_value(value):
+    """Converts the value field of a FITS header card to a python value.
+    
+    Inputs:
+        value: bytes following the "= " of a card, including any comment
+    Outputs:
+        value: str for quoted strings, int or float for numbers, and str for
+            anything else (e.g. logical values)
+        
+    """
+    
+    string, value = card_value_re.match(value).groups()
+    if string is not None:
+        return string.replace(b"''", b"'").rstrip().decode('ascii', 'replace')
+    
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        # FITS allows D as well as E for exponents.
+        return float(value.replace(b'D', b'E'))
+    except ValueError:
+        return value.decode('ascii', 'replace')
+
+def read_first_block(data_file):
+    """Reads the primary header of a FITS file, if it fits in the first block.
+    
+    FITS headers come in 2880-byte blocks of 36 80-byte cards, and the header
+    is finished by an END card. If END turns up in the first block, this is
+    all there is to read, and none of the rest of the file is touched.
+    
+    Inputs:
+        data_file: FITS file to be read
+    Outputs:
+        header: dictionary of the keywords in psrfits_keywords that appear in
+            the primary header and their values, or None if the header doesn't
+            end in the first block (or the file doesn't look like FITS at all)
+        
+    """
+    
+    with open(data_file, 'rb') as f:
+        block = f.read(2880)
+    if len(block) < 2880 or not block.startswith(b'SIMPLE  '):
+        return None
+    
+    header = {}
+    for i in range(0, 2880, 80):
+        card = block[i:i + 80]
+        key = card[:8].rstrip().decode('ascii', 'replace')
+        if key == 'END':
+            return header
+        # Only the values that are actually needed get converted.
+        if key in psrfits_keywords and card[8:10] == b'= ':
+            header[key] = parse_card_value(card[10:])
+    return None
+
+def read_sigproc_string(f):
+    """Reads a length-prefixed string from a SIGPROC header.
+    
+    Inputs:
+        f: filterbank file, opened in binary mode
+    Outputs:
+        string: the string read
+        
+    """
+    
+    length_bytes = f.read(4)
+    if len(length_bytes) < 4:
+        raise ValueError('SIGPROC header ended unexpectedly')
+    length, = struct.unpack('<i', length_bytes)
+    # Nothing in a real header comes close to this long, so anything longer
+    # means this isn't a SIGPROC header at all.
+    if length < 1 or length > 4096:
+        raise ValueError('not a SIGPROC header')
+    string = f.read(length)
+    if len(string) < length:
+        raise ValueError('SIGPROC header ended unexpectedly')
+    return string.decode('ascii', 'replace')
+
+def read_sigproc_header(data_file):
+    """Reads the header of a SIGPROC filterbank file.
+    
+    The header is a series of length-prefixed keywords, each followed by its
+    value, running from HEADER_START to HEADER_END. Only the header is read,
+    and the file is closed once HEADER_END is reached.
+    
+    Inputs:
+        data_file: filterbank file to be read
+    Outputs:
+        header: dictionary of keywords and values from the header
+        
+    """
+    
+    header = {}
+    with open(data_file, 'rb') as f:
+        if read_sigproc_string(f) != 'HEADER_START':
+            raise ValueError('not a SIGPROC header')
+        while True:
+            keyword = read_sigproc_string(f)
+            if keyword == 'HEADER_END':
+                return header
+            if keyword not in sigproc_keywords:
+                # Values aren't self-describing, so there's no way to skip
+                # past a keyword we don't know the type of.
+                raise ValueError('unknown SIGPROC header keyword {}'.format(keyword))
+            value_format = sigproc_keywords[keyword]
+            if value_format == 'str':
+                header[keyword] = read_sigproc_string(f)
+            elif value_format is not None:
+                value_bytes = f.read(struct.calcsize(value_format))
+                if len(value_bytes) < struct.calcsize(value_format):
+                    raise ValueError('SIGPROC header ended unexpectedly')
+                header[keyword], = struct.unpack(value_format, value_bytes)
+
+def read_fits_header(data_file):
+    """Reads the primary header of a FITS file.
     
-def parse_data(data_file):
+    Tries reading just the first block of the file, then fitsio if the header
+    is any longer than that, and astropy if fitsio isn't available.
+    
+    Inputs:
+        data_file: FITS file to be read
+    Outputs:
+        header: primary header, which can be indexed by keyword
+        
+    """
+    
+    header = read_first_block(data_file)
+    if header is not None:
+        return header
+    
+    if fitsio is not None:
+        try:
+            return fitsio.read_header(data_file, ext=0)
+        except Exception:
+            # Give astropy a go before giving up on the file.
+            pass
+    # memmap=False because only the header is read; there's no point
+    # setting up a memory map of the data that would never be touched.
+    return fits.getheader(data_file, ext=0, memmap=False)
+
+def parse_psrfits(data_file):
+    """Grabs the information of interest from the header of a PSRFITS file.
+    
+    Inputs:
+        data_file: PSRFITS file to be read
+    Outputs:
+        telescope: telescope
+        observer: observer
+        project_id: project code
+        source: source being observed
+        mode: observing mode
+        MJD: MJD of observation
+        center_freq: center of frequency band
+        
+    """
+    
+    header = read_fits_header(data_file)
+    
+    telescope = header['TELESCOP'].strip()
+    observer = header['OBSERVER'].strip()
+    project_id = header['PROJID'].strip()
+    source = header['SRC_NAME'].strip()
+    mode = header['OBS_MODE'].strip()
+    MJD = header['STT_IMJD'] + header['STT_SMJD'] / (24*60*60)
+    center_freq = header['OBSFREQ'] # MHz
+    
+    return telescope, observer, project_id, source, mode, MJD, center_freq
+
+def parse_filterbank(data_file):
+    """Grabs the information of interest from the header of a filterbank file.
+    
+    Inputs:
+        data_file: filterbank file to be read
+    Outputs:
+        Same as parse_psrfits. Filterbank headers don't record an observer,
+        project or observing mode, so these are always "Unknown".
+        
+    """
+    
+    header = read_sigproc_header(data_file)
+    
+    telescope = sigproc_telescopes.get(header.get('telescope_id'), 'Unknown')
+    observer = 'Unknown'
+    project_id = 'Unknown'
+    source = header['source_name'].strip()
+    mode = 'Unknown'
+    MJD = header['tstart']
+    # SIGPROC headers don't include the central frequency of the band,
+    # so you have to calculate that yourself. Note that if fch1 is the
+    # highest frequency, foff (the width of a channel) is negative.
+    center_freq = header['fch1'] + header['foff']*(header['nchans'] - 1)/2
+    
+    return telescope, observer, project_id, source, mode, MJD, center_freq
+
+# Which function reads which kind of file, by extension. Only files with one of
+# these extensions are looked at. To handle another format, write a function
+# like parse_psrfits for it and add its extensions here.
+parsers = {
+    '.fits': parse_psrfits,
+    '.sf': parse_psrfits,
+    '.rf': parse_psrfits,
+    '.fil': parse_filterbank,
+}
+# A tuple rather than a set so it can be handed straight to str.endswith.
+extensions = tuple(parsers)
+
+def parse_data(data_file, size):
     """Reads header of file and grabs the information of interest.
     
     Inputs:
         data_file: PSRFITS or filterbank file to be read
+        size: size of file (GB), as found when walking the data directory
     Outputs:
         path: path to file
         file: name of file
@@ -117,152 +380,510 @@ def parse_data(data_file):
     
     path, file = os.path.split(data_file)
     name, ext = os.path.splitext(data_file)
-    size = os.path.getsize(data_file) / 10**9 # GB
-    
-    if ext in ['.fits', '.sf', '.rf']:
-        info = pdat.PyPSRFITS(data_file)
-        header = info.hdr
-
-        telescope = header['TELESCOP'].strip()
-        observer = header['OBSERVER'].strip()
-        project_id = header['PROJID'].strip()
-        source = header['SRC_NAME'].strip()
-        mode = header['OBS_MODE'].strip()
-        MJD = header['STT_IMJD'] + header['STT_SMJD'] / (24*60*60)
-        center_freq = header['OBSFREQ'] # MHz
-    elif ext in ['.fil']:
-        info = FilReader(data_file)
-        header = info.header
+    
+    return (path, file, ext, size) + parsers[ext](data_file)
+
+def parse_data_safe(file_info):
+    """Wrapper around parse_data that doesn't raise if a file can't be read.
+    
+    This is what gets handed to the worker pool, so that one bad file doesn't
+    take down every other header read along with it.
+    
+    Inputs:
+        file_info: (path, size, modification time) for the file, as produced
+            by walk()
+    Outputs:
+        file_info: same as the input, so results can be matched up with files
+            when they come back from the pool out of order
+        result: the output of parse_data, or None if the file couldn't be read
         
-        telescope = header.telescope.strip()
-        observer = 'Unknown'
-        project_id = 'Unknown'
-        source = header.source.strip()
-        mode = 'Unknown'
-        MJD = header.tstart
-        # FilReader's header doesn't provide an option for the central
-        # frequency of the band, so you have to calculate that yourself.
-        # Note that if fch1 is the highest frequency, header.foff (the
-        # width of a channel) is negative.
-        center_freq = header.fch1 + header.foff*(header.nchans - 1)/2
-    
-    return path, file, ext, size, telescope, observer, project_id, source, mode, MJD, center_freq
-    
-#############################################################
-# Check whether relevant directories and output files exist #
-#############################################################
-if os.path.isdir(data_directory) == False:
-    print('Data directory {} does not exist!'.format(data_directory))
-    sys.exit()
-if os.path.isdir(output_directory) == False:
-    print('Output directory {} does not exist!'.format(output_directory))
-    sys.exit()
-if os.path.exists(os.path.join(output_directory, output_name)) == True:
-    print('There is already a file named {}!'.format(os.path.join(output_directory, output_name)))
-    sys.exit()
-
-# See https://stackoverflow.com/a/13891070/6535830 and comments below; using
-# .utcfromtimestamp() rather than .fromtimestamp() ensures you get the timestamp
-# in UTC, rather than the system's local time.
-start_time = time.time()
-start_timestamp = datetime.datetime.utcfromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S')
-
-################################
-# Pick files to search through #
-################################
-os.chdir(data_directory)
-
-extensions = ['.fits', '.sf', '.rf', '.fil'] # need to add .fil, etc.
-
-available_files = []
-for e in extensions:
-    available_files += glob.glob(os.path.abspath(data_directory) + '/**/*{}'.format(e), recursive=True)
-
-# 1000 files honestly isn't that much, but I wanted to set a fairly low threshold to err
-# on the side of caution. Realistically, if you're dealing with a couple orders of magnitude
-# more than this, you're probably trawling through an upper-level directory of a data
-# storage machine, which is hopefully a once-in-a-long-while thing.
-if len(available_files) > 10**3:
-    result = input(
-        'There are {} files to read. Are you sure you want to proceed? [Y/N] '.format(len(available_files)))
-    if result != 'Y':
+    """
+    
+    data_file, size, mtime = file_info
+    try:
+        return file_info, parse_data(data_file, size)
+    except Exception as error:
+        print('Could not read header of {} ({}); skipping it.'.format(data_file, error))
+        return file_info, None
+
+def load_cache(cache_file):
+    """Loads the results of reading headers on previous runs.
+    
+    Inputs:
+        cache_file: path to cache file
+    Outputs:
+        cache: dictionary mapping the (path, size, modification time) of each
+            file to the output of parse_data for it. Empty if there's no
+            cache file yet, or it can't be read.
+        
+    """
+    
+    # The cache is plain JSON rather than a pickle, since the output directory
+    # may well be writable by other people, and unpickling a file someone else
+    # has written lets them run code as you. JSON has no tuples, so the keys
+    # and results are turned back into them here.
+    try:
+        with open(cache_file) as f:
+            entries = json.load(f)
+        return {(path, size, mtime): tuple(result) for path, size, mtime, result in entries}
+    except Exception:
+        return {}
+
+def save_cache(cache, cache_file):
+    """Saves the results of reading headers for the next run.
+    
+    The cache is written to a temporary file first and moved into place, so an
+    interrupted save can't leave a corrupted cache behind. The temporary file
+    gets a unique name, so runs saving to the same cache at the same time
+    don't write over each other's; whichever finishes last wins.
+    
+    Inputs:
+        cache: dictionary as returned by load_cache
+        cache_file: path to cache file
+        
+    """
+    
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), prefix='.make_readme_cache.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump([[path, size, mtime, result] for (path, size, mtime), result in cache.items()], f)
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+def prefetch_header(data_file, length=16384):
+    """Asks the kernel to start reading the beginning of a file in the background.
+    
+    This doesn't wait for the read to happen; it just means a later read of the
+    header is likely to come straight from the page cache. Any errors are
+    ignored, since parse_data will find and report them anyway.
+    
+    Inputs:
+        data_file: file to be read later
+        length: number of bytes from the start of the file to read
+        
+    """
+    
+    try:
+        fd = os.open(data_file, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def prefetch_ahead(results, data_files, window, threads=32):
+    """Passes on results from the worker pool, prefetching files a little ahead.
+    
+    The first window files are prefetched straight away, and then one more
+    each time a result comes back, so the prefetching stays roughly window
+    files ahead of the workers. Getting much further ahead than that would
+    just mean headers being pushed back out of the page cache before a worker
+    got to them.
+    
+    Inputs:
+        results: iterator over results from the worker pool
+        data_files: files in the order the workers are reading them
+        window: how many files ahead of the workers to prefetch
+        threads: number of threads to prefetch with
+    Outputs:
+        The same results, one at a time
+        
+    """
+    
+    data_files = iter(data_files)
+    with multiprocessing.pool.ThreadPool(threads) as prefetcher:
+        for data_file in itertools.islice(data_files, window):
+            prefetcher.apply_async(prefetch_header, (data_file,))
+        for result in results:
+            for data_file in itertools.islice(data_files, 1):
+                prefetcher.apply_async(prefetch_header, (data_file,))
+            yield result
+
+def search_directory(directory, extensions, verbose, visited, linked):
+    """Finds files with the desired extensions in a directory and below it.
+    
+    Symlinks to directories aren't followed here; they're added to linked so
+    walk() can search them later.
+    
+    Inputs:
+        directory: directory to search
+        extensions: tuple of file extensions to look for
+        verbose: whether to report skipped symlinks and directories
+        visited: set of (device, inode) pairs of directories already searched,
+            which directories searched here are added to
+        linked: list that symlinks to directories are added to
+    Outputs:
+        Same as walk()
+        
+    """
+    
+    # Reading the whole listing up front means the directory is closed again
+    # before recursing, rather than holding one open per level of the tree.
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_symlink():
+            if entry.is_dir():
+                linked.append(entry.path)
+            elif verbose == True and entry.name.endswith(extensions):
+                print('{} is a symlink and will not be read.'.format(entry.path))
+        elif entry.is_dir(follow_symlinks=False):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in visited:
+                if verbose == True:
+                    print('{} has already been searched and will not be searched again.'.format(entry.path))
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            yield from search_directory(entry.path, extensions, verbose, visited, linked)
+        elif entry.is_file(follow_symlinks=False) and entry.name.endswith(extensions):
+            stat = entry.stat(follow_symlinks=False)
+            yield entry.path, stat.st_size / 10**9, stat.st_mtime_ns # GB, ns
+
+def walk(directory, extensions, verbose=False):
+    """Recursively finds files with the desired extensions in one pass.
+    
+    This replaces running a recursive glob once per extension, each of which
+    traversed the whole directory tree. Like glob, it skips hidden files and
+    directories, doesn't complain about directories it can't read, and follows
+    symlinks to directories. Symlinked files are skipped, using the file type
+    scandir already got from the directory listing instead of an extra lstat
+    per file.
+    
+    Every directory searched is remembered by its device and inode numbers, so
+    that a symlink pointing back up the tree (or to somewhere already searched)
+    doesn't send the walk round in circles or count files twice. The real
+    directories are all searched before any symlinked ones, so a file that can
+    be reached both ways is always found under its real path, and a symlink is
+    only followed if it leads somewhere new. That keeps the paths (and so the
+    cache) the same from run to run, whatever order the directories are
+    listed in.
+    
+    Inputs:
+        directory: directory to search
+        extensions: tuple of file extensions to look for
+        verbose: whether to report skipped symlinks and directories
+    Outputs:
+        (path, size, modification time) for matching files, one at a time,
+        with the size in GB and the modification time in nanoseconds
+        
+    """
+    
+    try:
+        stat = os.stat(directory)
+    except OSError:
+        return
+    visited = {(stat.st_dev, stat.st_ino)}
+    linked = []
+    yield from search_directory(directory, extensions, verbose, visited, linked)
+    
+    # Symlinks found inside the symlinked directories just join the end of the
+    # queue, so they're searched after everything found so far.
+    while linked:
+        link = linked.pop(0)
+        try:
+            stat = os.stat(link)
+        except OSError:
+            continue
+        if (stat.st_dev, stat.st_ino) in visited:
+            if verbose == True:
+                print('{} has already been searched and will not be searched again.'.format(link))
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+        yield from search_directory(link, extensions, verbose, visited, linked)
+
+def main():
+    parser = argparse.ArgumentParser(description='User inputs')
+    parser.add_argument('-d', help='Directory to search [Default: current working directory]', type=str)
+    parser.add_argument('-n', help='Name of output file [Default: "README.txt"]', type=str)
+    parser.add_argument('-l', help='Location of output file [Default: current working directory]', type=str)
+    parser.add_argument('-o', help='Owner of directory [Default: "Unknown"]', type=str)
+    parser.add_argument('-g', help='Person generating README [Default: "Unknown"]', type=str)
+    parser.add_argument('-v', help='Verbose option [Default: False]', type=bool)
+    parser.add_argument('-w', help='Number of headers to read at once, with no prefetching [Default: 32 for fewer '
+                        'than 10000 files, otherwise the number of CPUs plus prefetching]', type=int)
+    args = parser.parse_args()
+
+    ################################################################
+    # Use arguments and default values to change specific settings #
+    ################################################################
+    if args.d:
+        data_directory = args.d
+    else:
+        data_directory = os.getcwd() + '/'
+    if args.n:
+        output_name = args.n
+    else:
+        output_name = 'README.txt'
+    if args.l:
+        output_directory = args.l
+    else:
+        output_directory = os.getcwd() + '/'
+    if args.o:
+        owner = args.o
+    else:
+        owner = 'Unknown'
+    if args.g:
+        generator = args.g
+    else:
+        # getpass finds your username. It should work on both Windows and Unix systems.
+        generator = getpass.getuser()
+    if args.v:
+        verbose = args.v
+        if verbose not in [True, False]:
+            print('-v must be True or False!')
+            sys.exit()
+    else:
+        verbose = False
+    if args.w is not None:
+        workers = args.w
+        if workers < 1:
+            print('-w must be at least 1!')
+            sys.exit()
+    else:
+        workers = None
+
+    ############################################
+    # Check whether relevant directories exist #
+    ############################################
+    if os.path.isdir(data_directory) == False:
+        print('Data directory {} does not exist!'.format(data_directory))
+        sys.exit()
+    if os.path.isdir(output_directory) == False:
+        print('Output directory {} does not exist!'.format(output_directory))
         sys.exit()
 
-###############################################
-# Set up lists to hold quantities of interest #
-###############################################
-n_files = 0
-tot_size = 0
-exts = []
-telescopes = []
-observers = []
-project_ids = []
-sources = []
-modes = []
-MJDs = []
-center_freqs = []
-
-######################################
-# Go through desired files to search #
-######################################
-for af in available_files:
-    if os.path.islink(af) == False:
-        if verbose == True:
-            print('Reading header of {}.'.format(af))
-        path, file, ext, size, telescope, observer, project_id, source, mode, MJD, center_freq = parse_data(af)
-        n_files += 1
-        tot_size += size
-        if ext not in exts:
-            exts.append(ext)
-        if telescope not in telescopes:
-            telescopes.append(telescope)
-        if observer not in observers:
-            observers.append(observer)
-        if project_id not in project_ids:
-            project_ids.append(project_id)
-        if source not in sources:
-            sources.append(source)
-        if mode not in modes:
-            modes.append(mode)
-        if MJD not in MJDs:
-            MJDs.append(MJD)
-        if center_freq not in center_freqs:
-            center_freqs.append(center_freq)
+    # Fail now, rather than after reading every header, if the README's name is
+    # already taken. This is only a quick check; the README is created with an
+    # exclusive open when it's written, which is what actually guarantees an
+    # existing file is never overwritten.
+    if os.path.exists(os.path.join(output_directory, output_name)) == True:
+        print('There is already a file named {}!'.format(os.path.join(output_directory, output_name)))
+        sys.exit()
+
+    # Using time.gmtime() rather than time.localtime() ensures you get the timestamp
+    # in UTC, rather than the system's local time.
+    start_time = time.time()
+    start_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start_time))
+
+    # Everything written to the output directory uses its full path, since the
+    # working directory is about to change.
+    abs_output_directory = os.path.abspath(output_directory)
+    cache_file = os.path.join(abs_output_directory, '.make_readme_cache.json')
+    listing_name = os.path.splitext(output_name)[0] + '_files.jsonl'
+    listing_file = os.path.join(abs_output_directory, listing_name)
+
+    ################################
+    # Pick files to search through #
+    ################################
+    os.chdir(data_directory)
+
+    available_files = list(walk(os.path.abspath(data_directory), extensions, verbose))
+
+    # 1000 files honestly isn't that much, but I wanted to set a fairly low threshold to err
+    # on the side of caution. Realistically, if you're dealing with a couple orders of magnitude
+    # more than this, you're probably trawling through an upper-level directory of a data
+    # storage machine, which is hopefully a once-in-a-long-while thing.
+    if len(available_files) > 10**3:
+        result = input(
+            'There are {} files to read. Are you sure you want to proceed? [Y/N] '.format(len(available_files)))
+        if result != 'Y':
+            sys.exit()
+
+    ##############################################
+    # Set up sets to hold quantities of interest #
+    ##############################################
+    n_files = 0
+    tot_size = 0
+    exts = set()
+    telescopes = set()
+    observers = set()
+    project_ids = set()
+    sources = set()
+    modes = set()
+    # MJDs are continuous, so barely any two of them would ever be the same;
+    # just keeping track of the earliest and latest is much more useful.
+    mjd_min = None
+    mjd_max = None
+    center_freqs = set()
+
+    ######################################
+    # Go through desired files to search #
+    ######################################
+    # Files that were read on a previous run and haven't changed since (i.e.
+    # their size and modification time are the same) don't need reading again.
+    cache = load_cache(cache_file)
+    cached_files = [af for af in available_files if af in cache]
+    files_to_read = [af for af in available_files if af not in cache]
+    if verbose == True:
+        print('{} files already read on a previous run; {} to read.'.format(len(cached_files), len(files_to_read)))
+
+    # The details of each file are written out as soon as they come in, so they
+    # never need to be held in memory all at once. They go to a temporary file
+    # until the README itself has been successfully written. It gets a unique
+    # name so that other runs writing the same listing can't get mixed up in it.
+    # mkstemp makes the file readable only by you, so it's given the same
+    # permissions as any other new file (like the README) would get.
+    listing_fd, listing_temp = tempfile.mkstemp(dir=abs_output_directory, prefix='.' + listing_name + '.', suffix='.tmp')
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(listing_temp, 0o666 & ~umask)
+
+    # Reading headers is almost entirely waiting on the disk, so the files are
+    # farmed out to a pool of workers and the results collected as they come
+    # back. They come back in no particular order, but everything gathered
+    # here gets sorted before being written anyway.
+    #
+    # Since the workers spend most of their time waiting, threads are enough,
+    # and they're much cheaper to start than processes (especially on Windows,
+    # where each process has to re-import this script). For a lot of files,
+    # though, the time spent actually parsing headers starts to add up, and
+    # separate processes get around the GIL for that. On spinning disks, having
+    # lots of reads going at once can make the disk thrash; if so, try a small
+    # number of workers with -w, which also turns off the prefetching below.
+    #
+    # With only a process per CPU reading, there are far fewer reads going at
+    # once than with threads, so alongside the processes a pool of threads runs
+    # a little way ahead through the same files asking the kernel to start
+    # reading their headers. By the time a worker gets to a file it's usually
+    # already in memory. This makes the most difference on network filesystems
+    # and spinning disks. It's only possible where posix_fadvise exists (i.e.
+    # not on Windows); elsewhere the workers just read the files themselves.
+    # If the number of workers has been set with -w, there's no prefetching
+    # either, so that -w really is the number of reads going at once. The
+    # prefetching threads are only started once the worker processes are,
+    # so that the processes aren't forked while the threads are running.
+    if len(files_to_read) < 10**4:
+        pool = multiprocessing.pool.ThreadPool(workers if workers else 32)
+        prefetch = False
     else:
-        if verbose == True:
-            print('{} is a symlink and will not be read.'.format(af))
-            
-# Creates a version of the center frequencies as strings
-# to make it easier to list them in the README.
-string_center_freqs = [str(freq) for freq in center_freqs]
-        
-# I get seperate timestamps for starting and ending times for the edge case
-# where this is being run on a ton of files and a couple happen to be moved,
-# modified or deleted in the interim.
-end_time = time.time()
-end_timestamp = datetime.datetime.utcfromtimestamp(end_time).strftime('%Y-%m-%d %H:%M:%S')
-
-############################################################################
-# Write information to output file. This also creates a field for the user #
-# to manually add notes afterwards, although I intend for the output file  #
-# to be manually modified later anyway if needed.                          #
-############################################################################
-os.chdir(output_directory)
-
-output_file = open(output_name, 'w')
-output_file.write('README file for {} generated by {}.\n'.format(data_directory, __file__))
-output_file.write('Owner: {}\n'.format(owner))
-output_file.write('Generated by: {}\n'.format(generator))
-output_file.write('Started at {}; completed at {}.\n'.format(start_timestamp, end_timestamp))
-output_file.write('Number of files: {}\n'.format(n_files))
-output_file.write('Total size (GB): {:.2f}\n'.format(tot_size))
-output_file.write('File types: {}\n'.format(', '.join(sorted(exts))))
-output_file.write('Telescope: {}\n'.format(', '.join(sorted(telescopes))))
-output_file.write('Observers: {}\n'.format(', '.join(sorted(observers))))
-output_file.write('Project IDs: {}\n'.format(', '.join(sorted(project_ids))))
-output_file.write('Sources: {}\n'.format(', '.join(sorted(sources))))
-output_file.write('Modes: {}\n'.format(', '.join(sorted(modes))))
-output_file.write('Center frequencies (MHz): {}\n'.format(', '.join(sorted(string_center_freqs))))
-output_file.write('\n')
-output_file.write('Notes:')
-output_file.close()
+        n_processes = workers if workers else os.cpu_count()
+        pool = multiprocessing.Pool(n_processes)
+        prefetch = workers is None and hasattr(os, 'posix_fadvise')
+    with pool, os.fdopen(listing_fd, 'w') as listing:
+        read_results = pool.imap_unordered(parse_data_safe, files_to_read, chunksize=32)
+        if prefetch == True:
+            # Enough to cover the chunks the workers are on and the next ones.
+            read_results = prefetch_ahead(
+                read_results, (path for path, size, mtime in files_to_read), 2 * 32 * n_processes)
+        # Each result is tagged with whether it came from the cache, just so
+        # that -v can say which headers were actually read.
+        results = itertools.chain(
+            ((af, cache[af], True) for af in cached_files),
+            ((file_info, result, False) for file_info, result in read_results))
+        for file_info, result, from_cache in results:
+            if result is None:
+                continue
+            cache[file_info] = result
+            path, file, ext, size, telescope, observer, project_id, source, mode, MJD, center_freq = result
+            if verbose == True:
+                if from_cache == True:
+                    print('Using cached header of {}.'.format(os.path.join(path, file)))
+                else:
+                    print('Read header of {}.'.format(os.path.join(path, file)))
+            listing.write(json.dumps({
+                'name': file,
+                'path': path,
+                'type': ext,
+                'size_gb': size,
+                'telescope': telescope,
+                'observer': observer,
+                'project_id': project_id,
+                'source': source,
+                'mode': mode,
+                'mjd': MJD,
+                'center_freq_mhz': center_freq,
+            }) + '\n')
+            n_files += 1
+            tot_size += size
+            exts.add(ext)
+            telescopes.add(telescope)
+            observers.add(observer)
+            project_ids.add(project_id)
+            sources.add(source)
+            modes.add(mode)
+            if mjd_min is None or MJD < mjd_min:
+                mjd_min = MJD
+            if mjd_max is None or MJD > mjd_max:
+                mjd_max = MJD
+            # Rounded to the nearest 0.1 MHz so that the same setup calculated
+            # slightly differently in different files only shows up once.
+            center_freqs.add(round(center_freq, 1))
+
+    # Anything cached from this directory that wasn't seen this time has been
+    # changed, moved or deleted since, so there's no point keeping it around.
+    # Entries from other directories are left alone.
+    search_root = os.path.join(os.path.abspath(data_directory), '')
+    seen_files = set(available_files)
+    cache = {key: value for key, value in cache.items()
+             if key in seen_files or not key[0].startswith(search_root)}
+    save_cache(cache, cache_file)
+
+    # I get seperate timestamps for starting and ending times for the edge case
+    # where this is being run on a ton of files and a couple happen to be moved,
+    # modified or deleted in the interim.
+    end_time = time.time()
+    end_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(end_time))
+
+    ############################################################################
+    # Write information to output file. This also creates a field for the user #
+    # to manually add notes afterwards, although I intend for the output file  #
+    # to be manually modified later anyway if needed.                          #
+    ############################################################################
+    if n_files > 0:
+        mjd_range = '{:.5f} - {:.5f}'.format(mjd_min, mjd_max)
+    else:
+        mjd_range = ''
+
+    lines = [
+        'README file for {} generated by {}.'.format(data_directory, __file__),
+        'Owner: {}'.format(owner),
+        'Generated by: {}'.format(generator),
+        'Started at {}; completed at {}.'.format(start_timestamp, end_timestamp),
+        'Number of files: {}'.format(n_files),
+        'Total size (GB): {:.2f}'.format(tot_size),
+        'Details of each file: {}'.format(listing_name),
+        'File types: {}'.format(', '.join(sorted(exts))),
+        'Telescope: {}'.format(', '.join(sorted(telescopes))),
+        'Observers: {}'.format(', '.join(sorted(observers))),
+        'Project IDs: {}'.format(', '.join(sorted(project_ids))),
+        'Sources: {}'.format(', '.join(sorted(sources))),
+        'Modes: {}'.format(', '.join(sorted(modes))),
+        'MJD range: {}'.format(mjd_range),
+        'Center frequencies (MHz): {}'.format(', '.join('{:g}'.format(freq) for freq in sorted(center_freqs))),
+        '',
+        'Notes:',
+    ]
+
+    # Opening with 'x' only creates the file if it doesn't already exist, so
+    # an existing README can never be overwritten, even by another copy of
+    # this script that started after the check above.
+    try:
+        output_file = open(os.path.join(abs_output_directory, output_name), 'x')
+    except FileExistsError:
+        try:
+            os.remove(listing_temp)
+        except FileNotFoundError:
+            pass
+        print('There is already a file named {}!'.format(os.path.join(output_directory, output_name)))
+        sys.exit()
+    with output_file:
+        output_file.write('\n'.join(lines))
+    # The README was only just created, so any file listing already going by
+    # its name is left over from an old README and can be replaced.
+    os.replace(listing_temp, listing_file)
+
+
+if __name__ == '__main__':
+    main()